@@ -29,52 +29,60 @@
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
 import os
+import re
 import copy
 import torch
 import numpy as np
 import random
 from isaacgym import gymapi
 from isaacgym import gymutil
-import torch.nn.functional as F
 
+from rsl_rl.modules.him_estimator import split_and_normalize
 from legged_gym import LEGGED_GYM_ROOT_DIR, LEGGED_GYM_ENVS_DIR
 
 def is_primitive_type(obj):
     return not hasattr(obj, '__dict__')
 
+_PRIMITIVE_TYPES = (int, float, bool, str, bytes, type(None))
+
 def class_to_dict(obj) -> dict:
-    if not  hasattr(obj,"__dict__"):
+    if type(obj) in _PRIMITIVE_TYPES or not hasattr(obj, "__dict__"):
         return obj
+    # collect the public attribute names from the class hierarchy (and the instance) without the sorted dir() scan
+    klass = obj if isinstance(obj, type) else type(obj)
+    keys = {}
+    for base in reversed(klass.__mro__):
+        keys.update(dict.fromkeys(vars(base)))
+    if not isinstance(obj, type):
+        keys.update(dict.fromkeys(vars(obj)))
     result = {}
-    for key in dir(obj):
+    for key in keys:
         if key.startswith("_"):
             continue
-        element = []
         val = getattr(obj, key)
         if isinstance(val, list):
-            for item in val:
-                element.append(class_to_dict(item))
+            result[key] = [class_to_dict(item) for item in val]
         else:
-            element = class_to_dict(val)
-        result[key] = element
+            result[key] = class_to_dict(val)
     return result
 
 def update_class_from_dict(obj, dict_, strict= False):
     """ If strict, attributes that are not in dict_ will be removed from obj """
-    attr_names = [n for n in obj.__dict__.keys() if not (n.startswith("__") and n.endswith("__"))]
-    for attr_name in attr_names:
-        if not attr_name in dict_:
-            delattr(obj, attr_name)
-    for key, val in dict_.items():
-        attr = getattr(obj, key, None)
-        if attr is None or is_primitive_type(attr):
-            if isinstance(val, dict):
-                setattr(obj, key, copy.deepcopy(val))
-                update_class_from_dict(getattr(obj, key), val)
+    # walk the config tree with an explicit stack instead of one recursive call per nested class
+    stack = [(obj, dict_)]
+    while stack:
+        obj, dict_ = stack.pop()
+        if strict:
+            attr_names = [n for n in obj.__dict__ if not (n.startswith("__") and n.endswith("__")) and n not in dict_]
+            for attr_name in attr_names:
+                delattr(obj, attr_name)
+        for key, val in dict_.items():
+            attr = getattr(obj, key, None)
+            if attr is None or type(attr) in _PRIMITIVE_TYPES or is_primitive_type(attr):
+                # plain values (including dicts) are copied over as a whole
+                setattr(obj, key, copy.deepcopy(val) if isinstance(val, dict) else val)
             else:
-                setattr(obj, key, val)
-        else:
-            update_class_from_dict(attr, val)
+                stack.append((attr, val))
     return
 
 def set_seed(seed):
@@ -113,6 +121,8 @@ def parse_sim_params(args, cfg):
 
     return sim_params
 
+_MODEL_FILE_RE = re.compile(r'model_(\d+)\.pt')
+
 def get_load_path(root, load_run=-1, checkpoint=-1):
     if load_run==-1:
         try:
@@ -131,9 +141,13 @@ def get_load_path(root, load_run=-1, checkpoint=-1):
         print("[INFO] Loading load_run as relative path:", load_run)
 
     if checkpoint==-1:
-        models = [file for file in os.listdir(load_run) if 'model' in file]
-        models.sort(key=lambda m: '{0:0>15}'.format(m))
-        model = models[-1]
+        # pick the highest iteration number in a single pass, no sort needed
+        with os.scandir(load_run) as entries:
+            matches = (_MODEL_FILE_RE.fullmatch(entry.name) for entry in entries)
+            latest = max(((int(m.group(1)), m.group(0)) for m in matches if m), default=None)
+        if latest is None:
+            raise ValueError("No model checkpoints in this directory: " + load_run)
+        model = latest[1]
     else:
         model = "model_{}.pt".format(checkpoint) 
 
@@ -198,6 +212,15 @@ def get_args(custom_args=[]):
     #     args.sim_device += f":{args.sim_device_id}"
     return args
 
+def copy_module_to_cpu(module):
+    """ Copies a module to the cpu without first duplicating its parameters on their current device """
+    # pre-seed the deepcopy memo with cpu copies of the tensors so only the (cheap) module structure is copied
+    # copy=True so the result never shares storage with the source, even when it already lives on the cpu
+    memo = {id(param): torch.nn.Parameter(param.detach().to('cpu', copy=True), requires_grad=param.requires_grad)
+            for param in module.parameters()}
+    memo.update({id(buf): buf.detach().to('cpu', copy=True) for buf in module.buffers()})
+    return copy.deepcopy(module, memo)
+
 def export_policy_as_jit(actor_critic, path):
     if hasattr(actor_critic, 'estimator'):
         # assumes LSTM: TODO add GRU
@@ -206,8 +229,9 @@ def export_policy_as_jit(actor_critic, path):
     else: 
         os.makedirs(path, exist_ok=True)
         path = os.path.join(path, 'policy_1.pt')
-        model = copy.deepcopy(actor_critic.actor).to('cpu')
-        traced_script_module = torch.jit.script(model)
+        model = copy_module_to_cpu(actor_critic.actor).eval()
+        # the actor is a plain MLP, so tracing captures it completely; freezing folds the weights in as constants
+        traced_script_module = torch.jit.freeze(torch.jit.trace(model, torch.zeros(1, model[0].in_features)))
         traced_script_module.save(path)
 
 # class PolicyExporterLSTM(torch.nn.Module):
@@ -243,20 +267,19 @@ def export_policy_as_jit(actor_critic, path):
 class PolicyExporterHIM(torch.nn.Module):
     def __init__(self, actor_critic):
         super().__init__()
-        self.actor = copy.deepcopy(actor_critic.actor)
-        self.estimator = copy.deepcopy(actor_critic.estimator.encoder)
+        self.actor = copy_module_to_cpu(actor_critic.actor)
+        self.estimator = copy_module_to_cpu(actor_critic.estimator.encoder)
 
     def forward(self, obs_history):
-        parts = self.estimator(obs_history)[:, 0:19]
-        vel, z = parts[..., :3], parts[..., 3:]
-        z = F.normalize(z, dim=-1, p=2.0)
+        vel, z = split_and_normalize(self.estimator(obs_history)[:, 0:19])
         return self.actor(torch.cat((obs_history[:, 0:45], vel, z), dim=1))
 
     def export(self, path):
         os.makedirs(path, exist_ok=True)
         path = os.path.join(path, 'policy.pt')
         self.to('cpu')
-        traced_script_module = torch.jit.script(self)
+        self.eval()
+        traced_script_module = torch.jit.freeze(torch.jit.trace(self, torch.zeros(1, self.estimator[0].in_features)))
         traced_script_module.save(path)
     
     
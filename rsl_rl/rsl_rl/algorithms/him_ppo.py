@@ -28,6 +28,9 @@
 #
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
+import contextlib
+import inspect
+
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -35,6 +38,26 @@ import torch.optim as optim
 from rsl_rl.modules import HIMActorCritic
 from rsl_rl.storage import HIMRolloutStorage
 
+# the fused Adam kernel and multi-tensor gradient clipping only exist in recent PyTorch releases
+ADAM_SUPPORTS_FUSED = 'fused' in inspect.signature(optim.Adam).parameters
+CLIP_GRAD_SUPPORTS_FOREACH = 'foreach' in inspect.signature(nn.utils.clip_grad_norm_).parameters
+
+
+@torch.jit.script
+def kl_divergence_mean(sigma, old_sigma, mu, old_mu):
+    # KL(old || new) between diagonal Gaussians, scripted so the elementwise chain fuses into a single kernel
+    kl = torch.log(sigma / old_sigma + 1.e-5) + (torch.square(old_sigma) + torch.square(old_mu - mu)) / (2.0 * torch.square(sigma)) - 0.5
+    return torch.mean(torch.sum(kl, dim=-1))
+
+
+@torch.jit.script
+def clipped_surrogate_loss(actions_log_prob, old_actions_log_prob, advantages, clip_param: float):
+    # same as max(-A * ratio, -A * clamp(ratio, 1 - clip, 1 + clip)): only the bound on the side of sign(A) can be active
+    ratio = torch.exp(actions_log_prob - old_actions_log_prob)
+    clipped_ratio = torch.where(advantages >= 0, torch.clamp(ratio, max=1.0 + clip_param), torch.clamp(ratio, min=1.0 - clip_param))
+    return -torch.mean(advantages * clipped_ratio)
+
+
 class HIMPPO:
     actor_critic: HIMActorCritic
     def __init__(self,
@@ -51,20 +74,38 @@ class HIMPPO:
                  use_clipped_value_loss=True,
                  schedule="fixed",  # 'adaptive'
                  desired_kl=0.01,
+                 use_cuda_graph=False,
+                 use_bf16=False,
+                 storage_dtype=torch.float32,
                  device='cpu',  # 'cuda:0'
                  ):
 
         self.device = device
+        # replay the actor/critic training passes from CUDA graphs (captured on the first update)
+        self.use_cuda_graph = use_cuda_graph and torch.device(device).type == 'cuda'
+        # run the actor/critic forward passes of the update under bf16 autocast (Ampere or newer)
+        self.use_bf16 = use_bf16 and torch.device(device).type == 'cuda' and torch.cuda.is_bf16_supported()
+        if self.use_cuda_graph and self.use_bf16:
+            # the graphs are captured (and replayed) in fp32, the actor/critic passes would silently ignore the autocast
+            raise ValueError("use_cuda_graph and use_bf16 cannot be combined")
+        # side stream for the actor forward of the update, so the independent actor and critic kernels can overlap
+        self.actor_stream = torch.cuda.Stream(device=device) if torch.device(device).type == 'cuda' else None
 
         self.desired_kl = desired_kl
         self.schedule = schedule
         self.learning_rate = learning_rate
+        # dtype of the observation / action distribution rollout buffers, see HIMRolloutStorage
+        self.storage_dtype = storage_dtype
 
         # PPO components
         self.actor_critic = actor_critic
         self.actor_critic.to(self.device)
         self.storage = None # initialized later
-        self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=learning_rate)
+        if ADAM_SUPPORTS_FUSED and torch.device(device).type == 'cuda':
+            self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=learning_rate, fused=True)
+        else:
+            self.optimizer = optim.Adam(self.actor_critic.parameters(), lr=learning_rate)
+        self.clip_grad_kwargs = {'foreach': True} if CLIP_GRAD_SUPPORTS_FOREACH else {}
         self.transition = HIMRolloutStorage.Transition()
 
         # PPO parameters
@@ -79,7 +120,10 @@ class HIMPPO:
         self.use_clipped_value_loss = use_clipped_value_loss
 
     def init_storage(self, num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape):
-        self.storage = HIMRolloutStorage(num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape, self.device)
+        self.storage = HIMRolloutStorage(num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, action_shape, self.device,
+                                         storage_dtype=self.storage_dtype)
+        # persistent per-step (num_envs, 1) rewards buffer, process_env_step adds the time-out bootstrap to it in place
+        self.rewards_buffer = torch.zeros(num_envs, 1, device=self.device)
 
     def test_mode(self):
         self.actor_critic.test()
@@ -91,11 +135,13 @@ class HIMPPO:
         # 1. 计算当前观测下的 actions、其对数概率、正态分布的均值和方差
         # 2. 计算当前特权观测下的 价值
         # 3. 并存储这些数据 到 transition buffer 中
-        self.transition.actions = self.actor_critic.act(obs).detach()  # (num_envs, 12)
-        self.transition.values = self.actor_critic.evaluate(critic_obs).detach()  # (num_envs, 1)
-        self.transition.actions_log_prob = self.actor_critic.get_actions_log_prob(self.transition.actions).detach()
-        self.transition.action_mean = self.actor_critic.action_mean.detach()
-        self.transition.action_sigma = self.actor_critic.action_std.detach()
+        # must be called under torch.inference_mode() / torch.no_grad() (as the runner's rollout loop does),
+        # so the outputs carry no autograd graph and need no detach()
+        self.transition.actions = self.actor_critic.act(obs)  # (num_envs, 12)
+        self.transition.values = self.actor_critic.evaluate(critic_obs)  # (num_envs, 1)
+        self.transition.actions_log_prob = self.actor_critic.get_actions_log_prob(self.transition.actions)
+        self.transition.action_mean = self.actor_critic.action_mean
+        self.transition.action_sigma = self.actor_critic.action_std
         # need to record obs and critic_obs before env.step()
         self.transition.observations = obs
         self.transition.critic_observations = critic_obs
@@ -103,12 +149,14 @@ class HIMPPO:
     
     def process_env_step(self, rewards, dones, infos, next_critic_obs):
         # 1. 存储执行actions后的新特权观测、奖励buffer、重置buffer 到 transition buffer 中
-        self.transition.next_critic_observations = next_critic_obs.clone()
-        self.transition.rewards = rewards.clone()
-        self.transition.dones = dones
+        # next_critic_obs is only read by add_transitions, which copies it into the storage
+        self.transition.next_critic_observations = next_critic_obs
+        # rewards and dones are stored as (num_envs, 1) like the values
+        self.transition.rewards = self.rewards_buffer.copy_(rewards.unsqueeze(1))
+        self.transition.dones = dones.unsqueeze(1)
         # Bootstrapping on time outs
         if 'time_outs' in infos:
-            self.transition.rewards += self.gamma * torch.squeeze(self.transition.values * infos['time_outs'].unsqueeze(1).to(self.device), 1)
+            self.transition.rewards += self.gamma * self.transition.values * infos['time_outs'].unsqueeze(1).to(self.device)
 
         # 2. 将当前 env_step 完成后的数据 记录到 rollout 中
         self.storage.add_transitions(self.transition)
@@ -119,7 +167,8 @@ class HIMPPO:
     
     def compute_returns(self, last_critic_obs):
         # 根据 执行当前env_step的actions后获取的新特权观测 计算 价值
-        last_values= self.actor_critic.evaluate(last_critic_obs).detach()
+        # like act(), this runs under torch.inference_mode() in the runner
+        last_values = self.actor_critic.evaluate(last_critic_obs)
         self.storage.compute_returns(last_values, self.gamma, self.lam)
 
     def update(self):
@@ -128,14 +177,27 @@ class HIMPPO:
         mean_estimation_loss = 0
         mean_swap_loss = 0
         
+        if self.use_cuda_graph and self.actor_critic.graphed_mlps is None:
+            mini_batch_size = self.storage.num_envs * self.storage.num_transitions_per_env // self.num_mini_batches
+            self.actor_critic.capture_cuda_graphs(mini_batch_size)
+
         generator = self.storage.mini_batch_generator(self.num_mini_batches, self.num_learning_epochs)
 
         for obs_batch, critic_obs_batch, actions_batch, next_critic_obs_batch, target_values_batch, advantages_batch, returns_batch, old_actions_log_prob_batch, \
             old_mu_batch, old_sigma_batch in generator:
                 
-            self.actor_critic.act(obs_batch)
+            if self.actor_stream is not None:
+                self.actor_stream.wait_stream(torch.cuda.current_stream())
+            # the log-probabilities, losses and the estimator update stay in fp32
+            # autocast is only entered when enabled: torch 1.10 checks bf16 support on the current GPU even with enabled=False
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16) if self.use_bf16 else contextlib.nullcontext():
+                with torch.cuda.stream(self.actor_stream):
+                    # only the distribution is needed here, sampling an action (as act() does) would be wasted work
+                    self.actor_critic.update_distribution(obs_batch)
+                value_batch = self.actor_critic.evaluate(critic_obs_batch)
+            if self.actor_stream is not None:
+                torch.cuda.current_stream().wait_stream(self.actor_stream)
             actions_log_prob_batch = self.actor_critic.get_actions_log_prob(actions_batch)
-            value_batch = self.actor_critic.evaluate(critic_obs_batch)
             mu_batch = self.actor_critic.action_mean
             sigma_batch = self.actor_critic.action_std
             entropy_batch = self.actor_critic.entropy
@@ -143,9 +205,7 @@ class HIMPPO:
             # KL
             if self.desired_kl != None and self.schedule == 'adaptive':
                 with torch.inference_mode():
-                    kl = torch.sum(
-                        torch.log(sigma_batch / old_sigma_batch + 1.e-5) + (torch.square(old_sigma_batch) + torch.square(old_mu_batch - mu_batch)) / (2.0 * torch.square(sigma_batch)) - 0.5, axis=-1)
-                    kl_mean = torch.mean(kl)
+                    kl_mean = kl_divergence_mean(sigma_batch, old_sigma_batch, mu_batch, old_mu_batch)
 
                     if kl_mean > self.desired_kl * 2.0:
                         self.learning_rate = max(1e-5, self.learning_rate / 1.5)
@@ -159,11 +219,7 @@ class HIMPPO:
             estimation_loss, swap_loss = self.actor_critic.estimator.update(obs_batch, next_critic_obs_batch, lr=self.learning_rate)
 
             # Surrogate loss
-            ratio = torch.exp(actions_log_prob_batch - torch.squeeze(old_actions_log_prob_batch))
-            surrogate = -torch.squeeze(advantages_batch) * ratio
-            surrogate_clipped = -torch.squeeze(advantages_batch) * torch.clamp(ratio, 1.0 - self.clip_param,
-                                                                               1.0 + self.clip_param)
-            surrogate_loss = torch.max(surrogate, surrogate_clipped).mean()
+            surrogate_loss = clipped_surrogate_loss(actions_log_prob_batch, old_actions_log_prob_batch, advantages_batch, self.clip_param)
 
             # Value function loss
             if self.use_clipped_value_loss:
@@ -178,9 +234,9 @@ class HIMPPO:
             loss = surrogate_loss + self.value_loss_coef * value_loss - self.entropy_coef * entropy_batch.mean()
 
             # Gradient step
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
             loss.backward()
-            nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm)
+            nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.max_grad_norm, **self.clip_grad_kwargs)
             self.optimizer.step()
 
             mean_value_loss += value_loss.item()
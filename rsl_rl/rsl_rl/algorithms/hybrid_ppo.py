@@ -135,11 +135,12 @@ class HybridPPO:
     def process_env_step(self, rewards, dones, infos, amp_obs, next_critic_obs):
         # 1. 存储执行actions后的新特权观测、奖励buffer、重置buffer 到 transition buffer 中
         self.transition.next_critic_observations = next_critic_obs.clone()
-        self.transition.rewards = rewards.clone()
-        self.transition.dones = dones
+        # rewards and dones are stored as (num_envs, 1) like the values
+        self.transition.rewards = rewards.unsqueeze(1).clone()
+        self.transition.dones = dones.unsqueeze(1)
         # Bootstrapping on time outs
         if 'time_outs' in infos:
-            self.transition.rewards += self.gamma * torch.squeeze(self.transition.values * infos['time_outs'].unsqueeze(1).to(self.device), 1)
+            self.transition.rewards += self.gamma * self.transition.values * infos['time_outs'].unsqueeze(1).to(self.device)
 
         # not_done_idxs = (dones == False).nonzero().squeeze()
         self.amp_storage.insert(
@@ -218,10 +219,10 @@ class HybridPPO:
             estimation_loss, swap_loss = self.actor_critic.estimator.update(obs_batch, next_critic_obs_batch, lr=self.learning_rate)
 
             # Surrogate loss
-            ratio = torch.exp(actions_log_prob_batch - torch.squeeze(old_actions_log_prob_batch))
-            surrogate = -torch.squeeze(advantages_batch) * ratio
-            surrogate_clipped = -torch.squeeze(advantages_batch) * torch.clamp(ratio, 1.0 - self.clip_param,
-                                                                               1.0 + self.clip_param)
+            ratio = torch.exp(actions_log_prob_batch - old_actions_log_prob_batch)
+            surrogate = -advantages_batch * ratio
+            surrogate_clipped = -advantages_batch * torch.clamp(ratio, 1.0 - self.clip_param,
+                                                                1.0 + self.clip_param)
             surrogate_loss = torch.max(surrogate, surrogate_clipped).mean()
 
             # Value function loss
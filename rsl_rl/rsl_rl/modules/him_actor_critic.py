@@ -28,14 +28,18 @@
 #
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
+import math
 import numpy as np
 
 import torch
 import torch.nn as nn
-from torch.distributions import Normal
 from .actor_critic import ActorCritic, get_activation
 from rsl_rl.modules.him_estimator import HIMEstimator
 
+# constant terms of the diagonal Gaussian log-probability and entropy
+LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
+GAUSSIAN_ENTROPY_OFFSET = 0.5 + LOG_SQRT_2PI
+
 
 class HIMActorCritic(nn.Module):
     is_recurrent = False
@@ -97,10 +101,13 @@ class HIMActorCritic(nn.Module):
 
         # Action noise
         self.std = nn.Parameter(init_noise_std * torch.ones(num_actions))
-        self.distribution = None
-        # disable args validation for speedup
-        Normal.set_default_validate_args = False
-        
+        # the Gaussian action distribution is kept as raw tensors instead of a torch.distributions.Normal object
+        self.distribution_mean = None
+        self.distribution_log_std = None
+        # CUDA graphs of the actor/critic training passes, see capture_cuda_graphs()
+        self.graphed_mlps = None
+        self.graph_batch_size = None
+
         # seems that we get better performance without init
         # self.init_memory_weights(self.memory_a, 0.001, 0.)
         # self.init_memory_weights(self.memory_c, 0.001, 0.)
@@ -115,37 +122,62 @@ class HIMActorCritic(nn.Module):
     def reset(self, dones=None):
         pass
 
+    def capture_cuda_graphs(self, batch_size):
+        # 为固定大小的训练 batch 捕获 actor 和 critic 前向+反向传播的 CUDA graph，之后每个 mini batch 只需一次 graph replay
+        # the graphs share parameters with self.actor / self.critic, the (new) Sequential containers only carry the patched forward
+        device = self.std.device
+        actor_input = torch.zeros(batch_size, self.actor[0].in_features, device=device)
+        critic_input = torch.zeros(batch_size, self.critic[0].in_features, device=device)
+        # captured separately so each graph gets its own memory pool: the actor and critic graphs replay concurrently on
+        # different streams in HIMPPO.update, which callables sharing one pool must never do
+        # stored as a tuple so the graphed containers are not registered as submodules (and do not show up in the state_dict)
+        self.graphed_mlps = (torch.cuda.make_graphed_callables(nn.Sequential(*self.actor), (actor_input,)),
+                             torch.cuda.make_graphed_callables(nn.Sequential(*self.critic), (critic_input,)))
+        self.graph_batch_size = batch_size
+
+    def _mlp_forward(self, index, net, x):
+        # only the autograd (training) path with the captured batch size is replayed, rollout and inference run eagerly
+        if self.graphed_mlps is not None and torch.is_grad_enabled() and x.shape[0] == self.graph_batch_size:
+            return self.graphed_mlps[index](x)
+        return net(x)
+
     def forward(self):
         raise NotImplementedError
     
     @property
     def action_mean(self):
-        return self.distribution.mean
+        return self.distribution_mean
 
     @property
     def action_std(self):
-        return self.distribution.stddev
+        return self.std.expand_as(self.distribution_mean)
     
     @property
     def entropy(self):
-        return self.distribution.entropy().sum(dim=-1)
+        # the entropy only depends on the shared std, compute it once and broadcast it over the batch
+        entropy = (self.distribution_log_std + GAUSSIAN_ENTROPY_OFFSET).sum(dim=-1)
+        return entropy.expand(self.distribution_mean.shape[0])
 
     def update_distribution(self, obs_history):
         # 根据历史观测，计算policy输出的 actions正态分布的 均值，更新actions的 正态分布
         with torch.no_grad():
             vel, latent = self.estimator(obs_history)
         actor_input = torch.cat((obs_history[:, :self.num_one_step_obs], vel, latent), dim=-1)
-        mean = self.actor(actor_input)
-        self.distribution = Normal(mean, mean * 0. + self.std)
+        mean = self._mlp_forward(0, self.actor, actor_input)
+        self.distribution_mean = mean
+        self.distribution_log_std = torch.log(self.std)
 
     def act(self, obs_history=None, **kwargs):
         # 根据历史观测，更新actions的正态分布，并采样得到一个 actions
         self.update_distribution(obs_history)
-        return self.distribution.sample()
+        with torch.no_grad():
+            return self.distribution_mean + self.std * torch.randn_like(self.distribution_mean)
     
     def get_actions_log_prob(self, actions):
         # 计算 给定actions 在当前policy输出的actions正态分布下的 对数概率
-        return self.distribution.log_prob(actions).sum(dim=-1)  # (num_envs, 12) ==> (num_envs, 1)
+        # the normalization term is the same for every sample, so it is reduced over the (num_actions,) log std only
+        log_normalizer = (self.distribution_log_std + LOG_SQRT_2PI).sum(dim=-1)
+        return -0.5 * torch.square((actions - self.distribution_mean) / self.std).sum(dim=-1, keepdim=True) - log_normalizer  # (num_envs, 12) ==> (num_envs, 1)
 
     def act_inference(self, obs_history, observations=None):
         # 根据历史观测，计算policy输出的 actions正态分布的 均值，直接作为输出
@@ -155,5 +187,5 @@ class HIMActorCritic(nn.Module):
         return mean
 
     def evaluate(self, critic_observations, **kwargs):
-        value = self.critic(critic_observations)
+        value = self._mlp_forward(1, self.critic, critic_observations)
         return value
\ No newline at end of file
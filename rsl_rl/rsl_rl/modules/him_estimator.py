@@ -62,15 +62,11 @@ class HIMEstimator(nn.Module):
         return vel.detach(), z.detach()
 
     def forward(self, obs_history):
-        parts = self.encoder(obs_history.detach())
-        vel, z = parts[..., :3], parts[..., 3:]
-        z = F.normalize(z, dim=-1, p=2)
+        vel, z = split_and_normalize(self.encoder(obs_history.detach()))
         return vel.detach(), z.detach()
 
     def encode(self, obs_history):
-        parts = self.encoder(obs_history.detach())
-        vel, z = parts[..., :3], parts[..., 3:]
-        z = F.normalize(z, dim=-1, p=2)
+        vel, z = split_and_normalize(self.encoder(obs_history.detach()))
         return vel, z
 
     def update(self, obs_history, next_critic_obs, lr=None):
@@ -82,11 +78,9 @@ class HIMEstimator(nn.Module):
         vel = next_critic_obs[:, self.num_one_step_obs:self.num_one_step_obs+3].detach()
         next_obs = next_critic_obs.detach()[:, 3:self.num_one_step_obs+3]
 
-        z_s = self.encoder(obs_history)
+        pred_vel, z_s = split_and_normalize(self.encoder(obs_history))
         z_t = self.target(next_obs)
-        pred_vel, z_s = z_s[..., :3], z_s[..., 3:]
 
-        z_s = F.normalize(z_s, dim=-1, p=2)
         z_t = F.normalize(z_t, dim=-1, p=2)
 
         with torch.no_grad():
@@ -108,7 +102,7 @@ class HIMEstimator(nn.Module):
         estimation_loss = F.mse_loss(pred_vel, vel)
         losses = estimation_loss + swap_loss
 
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         losses.backward()
         nn.utils.clip_grad_norm_(self.parameters(), self.max_grad_norm)
         self.optimizer.step()
@@ -116,6 +110,16 @@ class HIMEstimator(nn.Module):
         return estimation_loss.item(), swap_loss.item()
 
 
+@torch.jit.script
+def split_and_normalize(parts):
+    # splits the encoder output into the velocity estimate and the L2-normalized latent (same eps as F.normalize),
+    # scripted so the slice, norm and division run as one fused kernel
+    vel = parts[..., :3]
+    z = parts[..., 3:]
+    z = z / torch.norm(z, p=2, dim=-1, keepdim=True).clamp_min(1e-12)
+    return vel, z
+
+
 @torch.no_grad()
 def sinkhorn(out, eps=0.05, iters=3):
     Q = torch.exp(out / eps).T
@@ -119,8 +119,8 @@ class HIMOnPolicyRunner:
                     termination_ids = termination_ids.to(self.device)
                     termination_privileged_obs = termination_privileged_obs.to(self.device)
 
-                    next_critic_obs = critic_obs.clone().detach()
-                    next_critic_obs[termination_ids] = termination_privileged_obs.clone().detach()
+                    next_critic_obs = critic_obs.clone()
+                    next_critic_obs[termination_ids] = termination_privileged_obs
                     # 3. 将当前env_step完成后的数据 记录到  rollout 中
                     self.alg.process_env_step(rewards, dones, infos, next_critic_obs)
 
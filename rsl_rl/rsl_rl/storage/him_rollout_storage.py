@@ -28,11 +28,49 @@
 #
 # Copyright (c) 2021 ETH Zurich, Nikita Rudin
 
+import contextlib
+
 import torch
 import numpy as np
 
 from rsl_rl.utils import split_and_pad_trajectories
 
+# multi-tensor copy (a single launch for a list of copies), only available in recent PyTorch releases
+HAS_FOREACH_COPY = hasattr(torch, '_foreach_copy_')
+# private CUDA memory pools that allocations can be routed to, only available in recent PyTorch releases
+HAS_MEM_POOL = hasattr(torch.cuda, 'MemPool') and hasattr(torch.cuda, 'use_mem_pool')
+
+
+def generalized_advantage_estimate(rewards, values, dones, last_values, gamma, gamma_lam,
+                                   not_terminal, next_values, deltas, discounts, advantages, returns):
+    # GAE: the TD residuals of all steps are computed at once, only the discounted sum is sequential,
+    # every intermediate is written in place into the preallocated scratch buffers
+    # (gamma and gamma * lam are passed as 0-dim tensors, so the compiled function is not specialized on their values)
+    not_terminal.copy_(dones).neg_().add_(1.0)
+    next_values[:-1].copy_(values[1:])
+    next_values[-1].copy_(last_values)
+    deltas.copy_(next_values).mul_(not_terminal).mul_(gamma).add_(rewards).sub_(values)
+    discounts.copy_(not_terminal).mul_(gamma_lam)
+    # A_t = delta_t + discount_t * A_{t+1}, scanned backwards over the time dimension
+    num_steps = deltas.shape[0]
+    advantages[num_steps - 1].copy_(deltas[num_steps - 1])
+    for i in range(1, num_steps):
+        step = num_steps - 1 - i
+        advantages[step].copy_(deltas[step]).addcmul_(discounts[step], advantages[step + 1])
+    returns.copy_(advantages).add_(values)
+
+    # Normalize the advantages, in place and with a single-pass std/mean reduction
+    advantages_std, advantages_mean = torch.std_mean(advantages)
+    advantages.sub_(advantages_mean).div_(advantages_std + 1e-8)
+
+
+# torch.compile (PyTorch >= 2.0) fuses the whole estimate for the fixed rollout shapes, older releases fall back to TorchScript
+if hasattr(torch, 'compile'):
+    generalized_advantage_estimate = torch.compile(generalized_advantage_estimate, dynamic=False)
+else:
+    generalized_advantage_estimate = torch.jit.script(generalized_advantage_estimate)
+
+
 class HIMRolloutStorage:
     class Transition:
         def __init__(self):
@@ -56,122 +94,235 @@ class HIMRolloutStorage:
                  obs_shape,  # [45 * 6]
                  privileged_obs_shape,  # [45+3+3+187]
                  actions_shape,  # [12]
-                 device='cpu'):
+                 device=None,  # defaults to 'cuda' when available, the transitions must be on (or copyable to) this device
+                 storage_dtype=torch.float32):
 
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.device = device
+        # dtype of the large observation and action distribution buffers (e.g. torch.bfloat16 to halve their memory traffic),
+        # the actions and the GAE quantities (rewards, values, returns, advantages, log probs) are always kept in fp32
+        self.storage_dtype = storage_dtype
 
         self.obs_shape = obs_shape
         self.privileged_obs_shape = privileged_obs_shape
         self.actions_shape = actions_shape
 
+        self.num_transitions_per_env = num_transitions_per_env
+        self.num_envs = num_envs
+
         # Core
-        self.observations = torch.zeros(num_transitions_per_env, num_envs, *obs_shape, device=self.device)  # (100, num_envs, 45*6)
+        # the per-step fields that are mini-batched live side by side in one (100 + 1, num_envs, total_dim) buffer per dtype,
+        # self.observations, self.actions, ... are views of the columns of their field: (name, shape, dtype) per field
+        # the extra last step only holds the privileged observations that follow the last transition, see below
+        fields = [('observations', obs_shape, storage_dtype)]  # (100, num_envs, 45*6)
+        if privileged_obs_shape[0] is not None:
+            fields += [('privileged_observations', privileged_obs_shape, storage_dtype)]  # (100, num_envs, 45+3+3+187)
+        fields += [('actions', actions_shape, torch.float32),
+                   # For PPO
+                   ('values', [1], torch.float32),
+                   ('advantages', [1], torch.float32),
+                   ('returns', [1], torch.float32),
+                   ('actions_log_prob', [1], torch.float32),
+                   ('mu', actions_shape, storage_dtype),
+                   ('sigma', actions_shape, storage_dtype)]
+        self.field_slices = {}  # name -> (dtype, first column, last column)
+        widths = {}
+        for name, shape, dtype in fields:
+            first = widths.get(dtype, 0)
+            widths[dtype] = first + shape[0]
+            self.field_slices[name] = (dtype, first, widths[dtype])
+        self.rollout_buffers = {dtype: torch.zeros(num_transitions_per_env + 1, num_envs, width, dtype=dtype, device=self.device)
+                                for dtype, width in widths.items()}
+        for name, (dtype, first, last) in self.field_slices.items():
+            setattr(self, name, self.rollout_buffers[dtype][:num_transitions_per_env, :, first:last])
+        # the next privileged observations are not stored as a buffer of their own: when an env is not done they equal the
+        # privileged observations of the following step, so they are read from the privileged buffer shifted by one step,
+        # whose extra last step receives the next privileged observations of the last transition; only the rows of the envs
+        # that terminated in between are kept aside, as (flat sample ids, rows) per step
         if privileged_obs_shape[0] is not None:
-            self.privileged_observations = torch.zeros(num_transitions_per_env, num_envs, *privileged_obs_shape, device=self.device)  # (100, num_envs, 45+3+3+187)
-            self.next_privileged_observations = torch.zeros(num_transitions_per_env, num_envs, *privileged_obs_shape, device=self.device)
+            dtype, first, last = self.field_slices['privileged_observations']
+            self.last_next_privileged_observations = self.rollout_buffers[dtype][num_transitions_per_env, :, first:last]
         else:
             self.privileged_observations = None
-            self.next_privileged_observations = None
+            self.last_next_privileged_observations = None
+        self.terminal_sample_ids = []
+        self.terminal_next_privileged_observations = []
         self.rewards = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.actions = torch.zeros(num_transitions_per_env, num_envs, *actions_shape, device=self.device)
-        self.dones = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device).byte()
+        self.dones = torch.zeros(num_transitions_per_env, num_envs, 1, dtype=torch.bool, device=self.device)
 
-        # For PPO
-        self.actions_log_prob = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.values = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.returns = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.advantages = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
-        self.mu = torch.zeros(num_transitions_per_env, num_envs, *actions_shape, device=self.device)
-        self.sigma = torch.zeros(num_transitions_per_env, num_envs, *actions_shape, device=self.device)
+        # scratch buffers of compute_returns, reused by every call
+        self.not_terminal = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
+        self.next_values = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
+        self.deltas = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
+        self.discounts = torch.zeros(num_transitions_per_env, num_envs, 1, device=self.device)
 
-        self.num_transitions_per_env = num_transitions_per_env
-        self.num_envs = num_envs
+        # shuffled sample indices, refilled in place on every mini_batch_generator call
+        self.indices = torch.empty(num_transitions_per_env * num_envs, dtype=torch.long, device=self.device)
+        # shuffled copy of every rollout buffer, each mini batch is a contiguous row range of it
+        self.shuffled_buffers = {dtype: torch.empty(num_transitions_per_env * num_envs, width, dtype=dtype, device=self.device)
+                                 for dtype, width in widths.items()}
+        # (shuffled buffer, first column, last column) of every field
+        shuffled_fields = {name: (self.shuffled_buffers[dtype], first, last) for name, (dtype, first, last) in self.field_slices.items()}
+        # the shuffled next privileged observations are gathered separately (see mini_batch_generator),
+        # without privileged observations the critic uses the actor observations
+        if self.privileged_observations is not None:
+            self.shuffled_next_privileged_observations = torch.empty(num_transitions_per_env * num_envs, *privileged_obs_shape,
+                                                                     dtype=storage_dtype, device=self.device)
+            critic_field = shuffled_fields['privileged_observations']
+            next_critic_field = (self.shuffled_next_privileged_observations, 0, privileged_obs_shape[0])
+        else:
+            self.shuffled_next_privileged_observations = None
+            critic_field = next_critic_field = shuffled_fields['observations']
+        # obs, critic_obs, actions, next_critic_obs, target_values, advantages, returns, old_actions_log_prob, old_mu, old_sigma
+        self.batch_field_slices = [shuffled_fields['observations'], critic_field, shuffled_fields['actions'], next_critic_field,
+                                   shuffled_fields['values'], shuffled_fields['advantages'], shuffled_fields['returns'],
+                                   shuffled_fields['actions_log_prob'], shuffled_fields['mu'], shuffled_fields['sigma']]
+        # position of every sample in the shuffled order, to place the kept-aside terminal rows
+        self.shuffled_positions = torch.empty(num_transitions_per_env * num_envs, dtype=torch.long, device=self.device)
+        self.sample_ids = torch.arange(num_transitions_per_env * num_envs, device=self.device)
+
+        # side stream that gathers the shuffled mini batches while the previous ones are trained on
+        self.copy_stream = torch.cuda.Stream(device=self.device) if torch.device(self.device).type == 'cuda' else None
+
+        # private memory pool for the transient tensors of compute_returns and mini_batch_generator, so they are recycled
+        # within the storage instead of fragmenting the global caching allocator pool between updates
+        self.memory_pool = torch.cuda.MemPool() if HAS_MEM_POOL and torch.device(self.device).type == 'cuda' else None
+
+        # pinned host buffers for transitions produced on the CPU, so their copies to the GPU storage can run asynchronously
+        self.host_staging_buffers = {}
+        self.host_staging_done = torch.cuda.Event() if torch.device(self.device).type == 'cuda' else None
 
         self.step = 0
 
+        # compile / optimize the advantage estimate for the rollout shapes now, instead of during the first update
+        # (under inference mode like the runner, and twice for the TorchScript profiling executor); the buffers are all zeros
+        with torch.inference_mode():
+            for _ in range(2):
+                self.compute_returns(torch.zeros(num_envs, 1, device=self.device), 0.99, 0.95)
+
+    def _transient_allocations(self):
+        if self.memory_pool is None:
+            return contextlib.nullcontext()
+        return torch.cuda.use_mem_pool(self.memory_pool, device=self.device)
+
+    def _stage_host_tensors(self, srcs):
+        # the staging buffers are reused every step, wait until the copies of the previous step have read them
+        self.host_staging_done.synchronize()
+        staged = []
+        for i, src in enumerate(srcs):
+            if src.device.type != 'cpu':
+                staged.append(src)
+                continue
+            buffer = self.host_staging_buffers.get(i)
+            if buffer is None or buffer.shape != src.shape or buffer.dtype != src.dtype:
+                buffer = torch.empty(src.shape, dtype=src.dtype, pin_memory=True)
+                self.host_staging_buffers[i] = buffer
+            staged.append(buffer.copy_(src))
+        return staged
+
     def add_transitions(self, transition: Transition):
+        """ Stores the transition of the current step.
+
+        The next critic observations are not stored for every step: for each env that is not done at step t,
+        transition.next_critic_observations of step t must equal transition.critic_observations of step t + 1
+        (as the runners build them), only the rows of the done envs and those of the last step are kept.
+        """
         if self.step >= self.num_transitions_per_env:
             raise AssertionError("Rollout buffer overflow")
         # 存储对应 env_step 的观测、特权观测、计算的actions、计算的价值
         # 存储执行该actions后获取的新特权观测、计算的奖励、需要重置的envID、该actions的对数概率、该actions正态分布的均值、该actions正态分布的方差
-        self.observations[self.step].copy_(transition.observations)
-        if self.privileged_observations is not None: self.privileged_observations[self.step].copy_(transition.critic_observations)
-        if self.next_privileged_observations is not None: self.next_privileged_observations[self.step].copy_(transition.next_critic_observations)
-        self.actions[self.step].copy_(transition.actions)
-        self.rewards[self.step].copy_(transition.rewards.view(-1, 1))
-        self.dones[self.step].copy_(transition.dones.view(-1, 1))
-        self.values[self.step].copy_(transition.values)
-        self.actions_log_prob[self.step].copy_(transition.actions_log_prob.view(-1, 1))
-        self.mu[self.step].copy_(transition.action_mean)
-        self.sigma[self.step].copy_(transition.action_sigma)
+        dsts = [self.observations[self.step], self.actions[self.step], self.rewards[self.step], self.dones[self.step],
+                self.values[self.step], self.actions_log_prob[self.step], self.mu[self.step], self.sigma[self.step]]
+        # rewards, dones and actions_log_prob are produced as (num_envs, 1) by the algorithm, like the values
+        srcs = [transition.observations, transition.actions, transition.rewards, transition.dones,
+                transition.values, transition.actions_log_prob, transition.action_mean, transition.action_sigma]
+        if self.privileged_observations is not None:
+            dsts.append(self.privileged_observations[self.step])
+            srcs.append(transition.critic_observations)
+            if self.step == self.num_transitions_per_env - 1:
+                dsts.append(self.last_next_privileged_observations)
+                srcs.append(transition.next_critic_observations)
+            else:
+                # for the envs that are not done, the next privileged observations are stored by the next step
+                terminal_env_ids = transition.dones.view(-1).nonzero(as_tuple=False).squeeze(-1)
+                self.terminal_sample_ids.append(terminal_env_ids.to(self.device) + self.step * self.num_envs)
+                self.terminal_next_privileged_observations.append(
+                    transition.next_critic_observations[terminal_env_ids].to(self.device, self.storage_dtype))
+        # only host sources are staged (and synchronized on), all-device transitions (the usual Isaac Gym case) go straight through
+        stage_host_tensors = self.host_staging_done is not None and any(src.device.type == 'cpu' for src in srcs)
+        if stage_host_tensors:
+            srcs = self._stage_host_tensors(srcs)
+        # device-to-device copies are asynchronous anyway, host sources are read from pinned staging buffers
+        if HAS_FOREACH_COPY:
+            torch._foreach_copy_(dsts, srcs, non_blocking=True)
+        else:
+            for dst, src in zip(dsts, srcs):
+                dst.copy_(src, non_blocking=True)
+        if stage_host_tensors:
+            self.host_staging_done.record()
         # 存储的 env_step + 1
         self.step += 1
 
     def clear(self):
         self.step = 0
+        self.terminal_sample_ids.clear()
+        self.terminal_next_privileged_observations.clear()
 
     def compute_returns(self, last_values, gamma, lam):
-        advantage = 0
-        for step in reversed(range(self.num_transitions_per_env)):
-            if step == self.num_transitions_per_env - 1:
-                next_values = last_values
-            else:
-                next_values = self.values[step + 1]
-            next_is_not_terminal = 1.0 - self.dones[step].float()
-            delta = self.rewards[step] + next_is_not_terminal * gamma * next_values - self.values[step]
-            advantage = delta + next_is_not_terminal * gamma * lam * advantage
-            self.returns[step] = advantage + self.values[step]
-
-        # Compute and normalize the advantages
-        self.advantages = self.returns - self.values
-        self.advantages = (self.advantages - self.advantages.mean()) / (self.advantages.std() + 1e-8)
+        with self._transient_allocations():
+            generalized_advantage_estimate(self.rewards, self.values, self.dones, last_values, torch.tensor(gamma), torch.tensor(gamma * lam),
+                                           self.not_terminal, self.next_values, self.deltas, self.discounts, self.advantages, self.returns)
 
     def get_statistics(self):
-        done = self.dones
-        done[-1] = 1
-        flat_dones = done.permute(1, 0, 2).reshape(-1, 1)
-        done_indices = torch.cat((flat_dones.new_tensor([-1], dtype=torch.int64), flat_dones.nonzero(as_tuple=False)[:, 0]))
-        trajectory_lengths = (done_indices[1:] - done_indices[:-1])
-        return trajectory_lengths.float().mean(), self.rewards.mean()
+        # the last step counts as done for every env, so the trajectories tile the whole (T, num_envs) rollout and their mean
+        # length is T * num_envs / number of dones, the stored dones are left untouched
+        num_dones = self.dones[:-1].sum() + self.num_envs
+        return float(self.num_transitions_per_env * self.num_envs) / num_dones, self.rewards.mean()
 
     def mini_batch_generator(self, num_mini_batches, num_epochs=8):
         batch_size = self.num_envs * self.num_transitions_per_env  # num_envs * 100
         mini_batch_size = batch_size // num_mini_batches  # (num_envs * 100) // 4
-        indices = torch.randperm(num_mini_batches*mini_batch_size, requires_grad=False, device=self.device)
+        indices = torch.randperm(batch_size, out=self.indices)
 
-        observations = self.observations.flatten(0, 1)  # (100 * num_envs, 45*6)
-        if self.privileged_observations is not None:
-            critic_observations = self.privileged_observations.flatten(0, 1)
-            next_critic_observations = self.next_privileged_observations.flatten(0, 1)
-        else:
-            critic_observations = observations
-            next_critic_observations = observations
+        # 每种 dtype 的 rollout buffer 按随机排列 gather 到 shuffled buffer，之后每个 mini batch 只是它的一段连续切片（视图，无拷贝）
+        # on CUDA the gather runs mini batch by mini batch on the copy stream, so the first mini batches are trained on
+        # while the following ones are still being gathered
+        if self.copy_stream is not None:
+            # the rollout buffers, the advantages and the permutation are all written on the current stream
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+        gathered_events = []
+        with torch.cuda.stream(self.copy_stream), self._transient_allocations():
+            if self.privileged_observations is not None:
+                # next privileged observations: the privileged buffer shifted by one step, with the terminal rows put back in
+                dtype, first, last = self.field_slices['privileged_observations']
+                next_privileged_observations = self.rollout_buffers[dtype][1:].view(batch_size, -1)[:, first:last]
+                torch.index_select(next_privileged_observations, 0, indices, out=self.shuffled_next_privileged_observations)
+                if self.terminal_sample_ids:
+                    self.shuffled_positions.index_copy_(0, indices, self.sample_ids)
+                    self.shuffled_next_privileged_observations.index_copy_(0, self.shuffled_positions[torch.cat(self.terminal_sample_ids)],
+                                                                           torch.cat(self.terminal_next_privileged_observations))
+            for i in range(num_mini_batches):
+                start = i * mini_batch_size
+                end = (i + 1) * mini_batch_size
+                for dtype, buffer in self.rollout_buffers.items():
+                    torch.index_select(buffer[:-1].view(batch_size, -1), 0, indices[start:end], out=self.shuffled_buffers[dtype][start:end])
+                if self.copy_stream is not None:
+                    gathered_events.append(self.copy_stream.record_event())
 
-        actions = self.actions.flatten(0, 1)
-        values = self.values.flatten(0, 1)
-        returns = self.returns.flatten(0, 1)
-        old_actions_log_prob = self.actions_log_prob.flatten(0, 1)
-        advantages = self.advantages.flatten(0, 1)
-        old_mu = self.mu.flatten(0, 1)
-        old_sigma = self.sigma.flatten(0, 1)
+        # the same permutation is used by every epoch, so the field views of each mini batch are built once per update
+        mini_batches = [[shuffled[i * mini_batch_size:(i + 1) * mini_batch_size, first:last]
+                         for shuffled, first, last in self.batch_field_slices] for i in range(num_mini_batches)]
 
         # 遍历 5 个 epoch
         for epoch in range(num_epochs):
             # 遍历 4 个 batch（batch_size = (num_envs * 100) // 4）
-            for i in range(num_mini_batches):
-                start = i * mini_batch_size
-                end = (i + 1) * mini_batch_size
-                batch_idx = indices[start:end]
-
-                obs_batch = observations[batch_idx]
-                next_critic_observations_batch = next_critic_observations[batch_idx]
-                critic_observations_batch = critic_observations[batch_idx]
-                actions_batch = actions[batch_idx]
-                target_values_batch = values[batch_idx]
-                returns_batch = returns[batch_idx]
-                old_actions_log_prob_batch = old_actions_log_prob[batch_idx]
-                advantages_batch = advantages[batch_idx]
-                old_mu_batch = old_mu[batch_idx]
-                old_sigma_batch = old_sigma[batch_idx]
-                yield obs_batch, critic_observations_batch, actions_batch, next_critic_observations_batch, target_values_batch, advantages_batch, returns_batch, \
-                       old_actions_log_prob_batch, old_mu_batch, old_sigma_batch
+            for i, mini_batch in enumerate(mini_batches):
+                if epoch == 0 and gathered_events:
+                    torch.cuda.current_stream().wait_event(gathered_events[i])
+
+                # obs, critic_obs, actions, next_critic_obs, target_values, advantages, returns, old_actions_log_prob, old_mu, old_sigma
+                # fields stored in a lower precision are upcast to fp32 for the networks (float() is a no-op for fp32 fields)
+                with self._transient_allocations():
+                    batch = [field.float() for field in mini_batch]
+                yield batch